@@ -17,12 +17,54 @@ Ellipsoid
     Generates 3-d ellipsoids
 '''
 
+import functools
+import itertools
+import threading
+from collections import OrderedDict
+
 import numpy as np
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
 from deeptrack.features import Feature, MERGE_STRATEGY_APPEND
 from deeptrack.image import Image
 
 
+# Masks cached by Scatterer._get_cached_mask, as an OrderedDict per subclass,
+# and the total number of bytes of the masks cached per subclass. Both are
+# guarded by _MASK_CACHE_LOCK, since generators may resolve features from
+# several threads.
+_MASK_CACHE = {}
+_MASK_CACHE_BYTES = {}
+_MASK_CACHE_LOCK = threading.Lock()
+
+# Whether to calculate large Ellipsoid masks on the GPU. Requires cupy and
+# a GPU, and is off by default since the GPU may be needed by tensorflow.
+# The GPU calculates in float32, so voxels on the surface of the ellipsoid
+# may be classified differently than on the CPU.
+USE_GPU = False
+
+# Minimum number of voxels for a mask to be calculated on the GPU. Smaller
+# masks are faster to calculate on the CPU than to transfer from the GPU.
+_GPU_MIN_VOXELS = 10**6
+
+# The mask of every PointParticle. Read-only, since it is shared.
+_POINT_PARTICLE_MASK = np.ones((1, 1, 1), dtype=np.float32)
+_POINT_PARTICLE_MASK.setflags(write=False)
+
 
 class Scatterer(Feature):
     '''Base abstract class for scatterers.
@@ -65,6 +107,12 @@ class Scatterer(Feature):
     __list_merge_strategy__ = MERGE_STRATEGY_APPEND
     __distributed__ = False
 
+    # Maximum number of masks, and of bytes, cached per subclass by
+    # `_get_cached_mask`. Masks larger than __mask_cache_bytes__ are never
+    # cached. Set __mask_cache_size__ to 0 to disable caching.
+    __mask_cache_size__ = 64
+    __mask_cache_bytes__ = 2**26
+
 
     def __init__(self,
                  position,
@@ -86,7 +134,9 @@ class Scatterer(Feature):
 
         if "position" in properties:
             if properties["position_unit"] == "meter":
-                properties["position"] = np.array(properties["position"]) / np.array(properties["voxel_size"])[:len(properties["position"])]
+                position = np.asarray(properties["position"])
+                voxel_size = np.asarray(properties["voxel_size"])
+                properties["position"] = position / voxel_size[:position.size]
         return properties
 
 
@@ -100,48 +150,137 @@ class Scatterer(Feature):
         # Post processes the created object to handle upsampling,
         # as well as cropping empty slices.
 
-        # Calculates upsampled voxel_size
         if upsample_axes is None:
                 upsample_axes = range(3)
 
-        voxel_size = np.array(voxel_size)
-        for axis in upsample_axes:
-            voxel_size[axis] /= upsample
-
-        # calls parent _process_and_get
-        new_image = super()._process_and_get(*args, voxel_size=voxel_size, upsample=upsample, **kwargs)
-        new_image = new_image[0]
-
-        # Downsamples the image along the axes it was upsampled
-        if upsample != 1 and upsample_axes:
-            
-            # Pad image to ensure it is divisible by upsample
-            increase = np.array(new_image.shape)
-            for axis in upsample_axes:
-                increase[axis] = upsample - (new_image.shape[axis] % upsample)
-            pad_width = [(0, inc) for inc in increase]
-            new_image = np.pad(new_image, pad_width, mode='constant')
-
-            # Finds reshape size for downsampling
-            new_shape = []
-            for axis in range(new_image.ndim):
-                if axis in upsample_axes:
-                    new_shape += [new_image.shape[axis] // upsample, upsample]
+        if upsample == 1 or not upsample_axes:
+            # No upsampling, so the image is used as is.
+            # asarray avoids copying voxel_size when it already is an array.
+            new_image = super()._process_and_get(*args, voxel_size=np.asarray(voxel_size), upsample=upsample, **kwargs)
+            new_image = new_image[0]
+
+        else:
+            axes = np.asarray(upsample_axes, dtype=int)
+
+            # Calculates upsampled voxel_size
+            voxel_size = np.array(voxel_size, dtype=float)
+            voxel_size[axes] /= upsample
+
+            # calls parent _process_and_get
+            new_image = super()._process_and_get(*args, voxel_size=voxel_size, upsample=upsample, **kwargs)
+            new_image = new_image[0]
+
+            # Downsamples the image along the axes it was upsampled.
+            # Pad image with zeros at the end to ensure it is divisible by upsample
+            padded_shape = np.array(new_image.shape)
+            padded_shape[axes] += -padded_shape[axes] % upsample
+
+            if np.any(padded_shape != new_image.shape):
+                padded_image = np.zeros(padded_shape, dtype=new_image.dtype)
+                padded_image[tuple(slice(0, size) for size in new_image.shape)] = new_image
+                new_image = padded_image
+
+            # Every axis is summed in the same accumulator type, which holds
+            # the sum of a full block. Binary (bool) masks sum to at most
+            # block_size, and are normalized to float32. Unsigned images are
+            # summed in the smallest unsigned integer type that fits, signed
+            # images in int64, and floats in at least float32.
+            block_size = upsample ** len(upsample_axes)
+            output_dtype = None
+            if new_image.dtype.kind == "b":
+                accumulator_dtype = np.min_scalar_type(block_size)
+                output_dtype = np.float32
+            elif new_image.dtype.kind == "u":
+                accumulator_dtype = np.min_scalar_type(block_size * int(np.iinfo(new_image.dtype).max))
+                if accumulator_dtype.kind != "u":
+                    # The sum may not fit in any integer type
+                    accumulator_dtype = np.float64
+            elif new_image.dtype.kind == "i":
+                accumulator_dtype = np.int64
+            else:
+                accumulator_dtype = np.result_type(new_image.dtype, np.float32)
+
+            # Downsamples by summing blocks of upsample voxels one axis at a
+            # time, such that each reshape acts on a contiguous array, and
+            # normalizes once at the end. Axes are reduced from the outermost,
+            # where the block sum adds contiguous slabs of memory.
+            for axis in sorted(upsample_axes):
+                if axis == new_image.ndim - 1:
+                    # Reducing a short trailing axis is slow, so the innermost
+                    # axis is instead summed as upsample strided slices.
+                    summed = np.array(new_image[..., 0::upsample], dtype=accumulator_dtype)
+                    for offset in range(1, upsample):
+                        summed += new_image[..., offset::upsample]
+                    new_image = summed
                 else:
-                    new_shape += [new_image.shape[axis]]
+                    shape = new_image.shape
+                    block_shape = shape[:axis] + (shape[axis] // upsample, upsample) + shape[axis + 1:]
+                    new_image = np.reshape(new_image, block_shape).sum(axis=axis + 1, dtype=accumulator_dtype)
+
+            new_image = np.divide(new_image, block_size, dtype=output_dtype)
 
-            # Downsamples
-            new_image = np.reshape(new_image, new_shape).mean(axis=tuple(np.array(upsample_axes, dtype=np.int32) * 2 + 1))
-            
         # Crops empty slices
         if crop_empty:
-            new_image = new_image[~np.all(new_image == 0, axis=(1, 2))]
-            new_image = new_image[:, ~np.all(new_image == 0, axis=(0, 2))]
-            new_image = new_image[:, :, ~np.all(new_image == 0, axis=(0, 1))]
+            is_nonzero = new_image != 0
+            new_image = new_image[is_nonzero.any(axis=(1, 2))]
+            new_image = new_image[:, is_nonzero.any(axis=(0, 2))]
+            new_image = new_image[:, :, is_nonzero.any(axis=(0, 1))]
+
+        # Binary masks that were not downsampled are returned as float32
+        if new_image.dtype.kind == "b":
+            new_image = new_image.astype(np.float32)
 
         return [Image(new_image)]
 
 
+    def _get_cached_mask(self, **properties):
+        # Returns the mask created by `_create_mask` for the given properties.
+        # Masks do not depend on the position, so they are cached per subclass
+        # and reused whenever the same shape is drawn again. The cache keeps
+        # the most recently used masks, within __mask_cache_size__ masks and
+        # __mask_cache_bytes__ bytes. Cached masks are read-only; they are
+        # copied once wrapped in an Image.
+
+        if self.__mask_cache_size__ <= 0:
+            return self._create_mask(**properties)
+
+        key = tuple((name, *np.ravel(value)) for name, value in properties.items())
+        scatterer_type = type(self)
+
+        with _MASK_CACHE_LOCK:
+            cache = _MASK_CACHE.setdefault(scatterer_type, OrderedDict())
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+
+        # The mask is created outside the lock, so that threads creating
+        # different masks do not wait for each other.
+        mask = self._create_mask(**properties)
+
+        if mask.nbytes > self.__mask_cache_bytes__:
+            return mask
+
+        mask.setflags(write=False)
+
+        with _MASK_CACHE_LOCK:
+            if key in cache:
+                # Another thread created the same mask meanwhile
+                cache.move_to_end(key)
+                return cache[key]
+
+            cache[key] = mask
+            cached_bytes = _MASK_CACHE_BYTES.get(scatterer_type, 0) + mask.nbytes
+
+            # Discards the least recently used masks until within the limits
+            while len(cache) > self.__mask_cache_size__ or cached_bytes > self.__mask_cache_bytes__:
+                _, discarded = cache.popitem(last=False)
+                cached_bytes -= discarded.nbytes
+
+            _MASK_CACHE_BYTES[scatterer_type] = cached_bytes
+
+        return mask
+
+
 
 class PointParticle(Scatterer):
     '''Generates a point particle
@@ -170,7 +309,7 @@ class PointParticle(Scatterer):
 
     def get(self, image, **kwargs):
 
-        return np.ones((1, 1, 1)) * 1.0
+        return _POINT_PARTICLE_MASK
 
 
 class Ellipse(Scatterer):
@@ -215,7 +354,7 @@ class Ellipse(Scatterer):
         properties = super()._process_properties(properties)
 
         # Ensure radius is of length 2
-        radius = np.array(properties["radius"])
+        radius = np.asarray(properties["radius"])
         if radius.ndim == 0:
             radius = np.array((properties["radius"], properties["radius"]))
         elif radius.size == 1:
@@ -228,21 +367,40 @@ class Ellipse(Scatterer):
 
 
     def get(self, *ignore, radius, rotation, voxel_size, **kwargs):
-        
+
+        return self._get_cached_mask(radius=radius, rotation=rotation, voxel_size=voxel_size)
+
+
+    def _create_mask(self, radius, rotation, voxel_size):
+
         # Create a grid to calculate on
         rad = radius[:2] / voxel_size[:2]
         ceil = int(np.max(np.ceil(rad)))
-        X, Y = np.meshgrid(np.arange(-ceil, ceil), np.arange(-ceil, ceil))
 
-        # Rotate the grid
-        if rotation != 0:
-            Xt =  (X * np.cos(-rotation) + Y * np.sin(-rotation))
-            Yt = (-X * np.sin(-rotation) + Y * np.cos(-rotation))
-            X = Xt
-            Y = Yt 
+        if rotation == 0:
+            # The ellipse is symmetric about both axes, so only the
+            # non-negative quadrant is evaluated and then reflected.
+            x = _arange(0, ceil + 1)
+            X = x[None, :]
+            Y = x[:, None]
+            quadrant = (X * X) / (rad[0] * rad[0]) + (Y * Y) / (rad[1] * rad[1]) < 1
+            mask = _reflect_orthant(quadrant)
+
+        else:
+            x = _arange(-ceil, ceil)
+            X = x[None, :]
+            Y = x[:, None]
+
+            # Rotate the grid by -rotation. The rotated coordinates are
+            # broadcast from the 1-d axes.
+            cos = np.cos(rotation)
+            sin = np.sin(rotation)
+            XR = cos * X - sin * Y
+            YR = sin * X + cos * Y
+
+            # Evaluate ellipse
+            mask = ((XR * XR) / (rad[0] * rad[0]) + (YR * YR) / (rad[1] * rad[1]) < 1)
 
-        # Evaluate ellipse
-        mask = ((X * X) / (rad[0] * rad[0]) + (Y * Y) / (rad[1] * rad[1]) < 1) * 1.0
         mask = np.expand_dims(mask, axis=-1)
         return mask
 
@@ -282,15 +440,23 @@ class Sphere(Scatterer):
             voxel_size,
             **kwargs):
 
-        # Create a grid to calculate on
-        rad = radius / voxel_size
-        rad_ceil = np.ceil(rad)
-        x = np.arange(-rad_ceil[0], rad_ceil[0])
-        y = np.arange(-rad_ceil[1], rad_ceil[1])
-        z = np.arange(-rad_ceil[2], rad_ceil[2])
-        X, Y, Z = np.meshgrid((x / rad[0])**2, (y / rad[1])**2, (z / rad[2])**2)
+        return self._get_cached_mask(radius=radius, voxel_size=voxel_size)
+
 
-        mask = (X + Y + Z <= 1) * 1.0
+    def _create_mask(self, radius, voxel_size):
+
+        # Create a grid to calculate on. The sphere is symmetric about
+        # each axis, so only the non-negative octant is evaluated.
+        rad = radius / voxel_size
+        rad_ceil = np.ceil(rad).astype(int)
+        x = (_arange(0, rad_ceil[0] + 1) / rad[0])**2
+        y = (_arange(0, rad_ceil[1] + 1) / rad[1])**2
+        z = (_arange(0, rad_ceil[2] + 1) / rad[2])**2
+
+        # Broadcasts the 1-d axes instead of building full grids.
+        # Axis order follows the previous meshgrid layout (y, x, z).
+        octant = y[:, None, None] + x[None, :, None] + z[None, None, :] <= 1
+        mask = _reflect_orthant(octant)
         return mask
 
 
@@ -330,44 +496,24 @@ class Ellipsoid(Scatterer):
     def _process_properties(self, propertydict):
         '''Preprocess the input to the method .get()
 
-        Ensures that the radius and the rotation properties both are arrays of
+        Ensures that the radius and the rotation properties both are tuples of
         length 3.
 
         If the radius is a single value, the particle is made a sphere
         If the radius are two values, the smallest value is appended as the third value
 
         The rotation vector is padded with zeros until it is of length 3
+
+        Values beyond the third are ignored. Raises a ValueError if either
+        property is empty.
         '''
 
-        # Ensure radius has three values
-        radius = np.array(propertydict["radius"])
-        if radius.ndim == 0:
-            radius = np.array([radius])
-        if radius.size == 1:
-            # If only one value, assume sphere
-            radius = (*radius,) * 3
-        elif radius.size == 2:
-            # If two values, duplicate the minor axis
-            radius = (*radius, np.min(radius[-1]))
-        elif radius.size == 3:
-            # If three values, convert to tuple for consistency
-            radius = (*radius, )
-        propertydict["radius"] = radius
-
-        # Ensure rotation has three values
-        rotation = np.array(propertydict["rotation"])
-        if rotation.ndim == 0:
-            rotation = np.array([rotation])
-        if rotation.size == 1:
-            # If only one value, pad with two zeros
-            rotation = (*rotation, 0, 0) 
-        elif rotation.size == 2:
-            # If two values, pad with one zero
-            rotation = (*rotation, 0)
-        elif rotation.size == 3:
-            # If three values, convert to tuple for consistency
-            rotation = (*rotation, )
-        propertydict["rotation"] = rotation
+        # Ensure radius has three values. Missing values repeat the last one,
+        # so a single value gives a sphere and two values duplicate the minor axis
+        propertydict["radius"] = _to_length_3(propertydict["radius"], name="radius")
+
+        # Ensure rotation has three values, padding with zeros
+        propertydict["rotation"] = _to_length_3(propertydict["rotation"], fill=0, name="rotation")
 
         return propertydict
 
@@ -379,22 +525,187 @@ class Ellipsoid(Scatterer):
             voxel_size,
             **kwargs):
 
+        return self._get_cached_mask(radius=radius, rotation=rotation, voxel_size=voxel_size)
+
+
+    def _create_mask(self, radius, rotation, voxel_size):
+
         radius_in_pixels = radius / voxel_size
         max_rad = np.max(radius) / voxel_size
         rad_ceil = np.ceil(max_rad)
 
-        # Create grid to calculate on
-        x = np.arange(-rad_ceil[0], rad_ceil[0])
-        y = np.arange(-rad_ceil[1], rad_ceil[1])
-        z = np.arange(-rad_ceil[2], rad_ceil[2])
-        X, Y, Z = np.meshgrid(x, y, z)
-
-        # Rotate the grid
+        # Rotation matrix. The rotated coordinates are divided by the radii
+        # after the rotation, as scaling the matrix instead moves voxels on
+        # the surface in or out of the ellipsoid.
         cos = np.cos(rotation)
         sin = np.sin(rotation)
-        XR = (cos[0] * cos[1] * X) + (cos[0] * sin[1] * sin[2] - sin[0] * cos[2]) * Y + (cos[0] * sin[1] * cos[2] + sin[0] * sin[2]) * Z
-        YR = (sin[0] * cos[1] * X) + (sin[0] * sin[1] * sin[2] + cos[0] * cos[2]) * Y + (sin[0] * sin[1] * cos[2] - cos[0] * sin[2]) * Z
-        ZR = (-sin[1] * X) + cos[1] * sin[2] * Y + cos[1] * cos[2] * Z 
-
-        mask = ((XR / radius_in_pixels[0])**2 + (YR / radius_in_pixels[1])**2 + (ZR / radius_in_pixels[2])**2 < 1) * 1.0
+        R = np.array([
+            [cos[0] * cos[1],
+             cos[0] * sin[1] * sin[2] - sin[0] * cos[2],
+             cos[0] * sin[1] * cos[2] + sin[0] * sin[2]],
+            [sin[0] * cos[1],
+             sin[0] * sin[1] * sin[2] + cos[0] * cos[2],
+             sin[0] * sin[1] * cos[2] - cos[0] * sin[2]],
+            [-sin[1],
+             cos[1] * sin[2],
+             cos[1] * cos[2]]
+        ])
+
+        # Axis order follows the previous meshgrid layout (y, x, z).
+        shape = (2 * int(rad_ceil[1]), 2 * int(rad_ceil[0]), 2 * int(rad_ceil[2]))
+
+        if USE_GPU and np.prod(shape) >= _GPU_MIN_VOXELS and _gpu_available():
+            try:
+                x = cupy.arange(-int(rad_ceil[0]), int(rad_ceil[0]), dtype=cupy.float32)[None, :, None]
+                y = cupy.arange(-int(rad_ceil[1]), int(rad_ceil[1]), dtype=cupy.float32)[:, None, None]
+                z = cupy.arange(-int(rad_ceil[2]), int(rad_ceil[2]), dtype=cupy.float32)[None, None, :]
+                mask = _ellipsoid_kernel()(x, y, z,
+                                           cupy.asarray(np.ravel(R), dtype=cupy.float32),
+                                           cupy.asarray(radius_in_pixels, dtype=cupy.float32))
+                return cupy.asnumpy(mask)
+            except (cupy.cuda.memory.OutOfMemoryError,
+                    cupy.cuda.runtime.CUDARuntimeError,
+                    cupy.cuda.driver.CUDADriverError):
+                # Falls back to the CPU, e.g. if the GPU is out of memory
+                pass
+
+        if njit is not None:
+            mask = np.empty(shape, dtype=bool)
+            _ellipsoid_mask(mask, -rad_ceil[0], -rad_ceil[1], -rad_ceil[2], R, radius_in_pixels)
+            return mask
+
+        # Create grid to calculate on, as broadcastable 1-d axes.
+        x = _arange(-int(rad_ceil[0]), int(rad_ceil[0]))[None, :, None]
+        y = _arange(-int(rad_ceil[1]), int(rad_ceil[1]))[:, None, None]
+        z = _arange(-int(rad_ceil[2]), int(rad_ceil[2]))[None, None, :]
+
+        if numexpr is not None:
+            # The x and y terms of each rotated coordinate only span a plane,
+            # so they are summed beforehand. numexpr then evaluates the rest
+            # of the expression in a single blocked pass.
+            mask = numexpr.evaluate(
+                "((xy0 + z0) / r0)**2 + ((xy1 + z1) / r1)**2 + ((xy2 + z2) / r2)**2 < 1",
+                local_dict={
+                    "xy0": R[0, 0] * x + R[0, 1] * y, "z0": R[0, 2] * z,
+                    "xy1": R[1, 0] * x + R[1, 1] * y, "z1": R[1, 2] * z,
+                    "xy2": R[2, 0] * x + R[2, 1] * y, "z2": R[2, 2] * z,
+                    "r0": radius_in_pixels[0],
+                    "r1": radius_in_pixels[1],
+                    "r2": radius_in_pixels[2],
+                }
+            )
+            return mask
+
+        mask = _ellipsoid_quadric(R, radius_in_pixels, x, y, z) < 1
         return mask
+
+
+
+@functools.lru_cache(maxsize=64)
+def _arange(start, stop):
+    # Cached np.arange of integer grid coordinates. The returned array is
+    # shared between calls, and is therefore read-only.
+
+    values = np.arange(start, stop)
+    values.setflags(write=False)
+    return values
+
+
+
+def _to_length_3(value, fill=None, name="value"):
+    # Converts value to a tuple of length 3. Missing values are set to fill,
+    # or to the last given value if fill is None. Values beyond the third
+    # are dropped.
+
+    value = np.ravel(np.asarray(value, dtype=float))[:3]
+    if value.size == 0:
+        raise ValueError("Expected {0} to have at least one value".format(name))
+
+    padded = np.full(3, value[-1] if fill is None else fill, dtype=float)
+    padded[:value.size] = value
+    return tuple(padded)
+
+
+
+def _ellipsoid_quadric(R, radius, x, y, z):
+    # Evaluates the quadric of an ellipsoid, which is smaller than 1 inside
+    # it, at the broadcastable coordinates x, y and z, with `R` the rotation
+    # matrix from Ellipsoid._create_mask and `radius` in pixels.
+
+    return (((R[0, 0] * x + R[0, 1] * y + R[0, 2] * z) / radius[0])**2
+            + ((R[1, 0] * x + R[1, 1] * y + R[1, 2] * z) / radius[1])**2
+            + ((R[2, 0] * x + R[2, 1] * y + R[2, 2] * z) / radius[2])**2)
+
+
+
+@functools.lru_cache(maxsize=1)
+def _gpu_available():
+    # Checks whether cupy can reach a GPU. This initializes CUDA, so it is
+    # only done on first use rather than on import.
+
+    if cupy is None:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except cupy.cuda.runtime.CUDARuntimeError:
+        return False
+
+
+
+@functools.lru_cache(maxsize=1)
+def _ellipsoid_kernel():
+    # Builds the cupy kernel that evaluates the rotated quadric of an
+    # ellipsoid in a single float32 pass, with the same arguments as
+    # _ellipsoid_quadric. `R` is passed flattened.
+
+    return cupy.ElementwiseKernel(
+        "float32 x, float32 y, float32 z, raw float32 R, raw float32 radius",
+        "bool inside",
+        """
+        float xr = (R[0] * x + R[1] * y + R[2] * z) / radius[0];
+        float yr = (R[3] * x + R[4] * y + R[5] * z) / radius[1];
+        float zr = (R[6] * x + R[7] * y + R[8] * z) / radius[2];
+        inside = xr * xr + yr * yr + zr * zr < 1;
+        """,
+        "deeptrack_ellipsoid_mask"
+    )
+
+
+
+def _reflect_orthant(orthant):
+    # Builds a mask that is symmetric about each axis from its non-negative
+    # orthant. Along an axis of length n + 1, `orthant` holds the coordinates
+    # 0, ..., n, and the output of length 2 * n holds -n, ..., n - 1.
+
+    ends = [size - 1 for size in orthant.shape]
+    mask = np.empty([2 * end for end in ends], dtype=orthant.dtype)
+
+    for is_positive in itertools.product((False, True), repeat=orthant.ndim):
+        target = tuple(slice(end, None) if positive else slice(0, end)
+                       for positive, end in zip(is_positive, ends))
+        source = tuple(slice(0, end) if positive else slice(end, 0, -1)
+                       for positive, end in zip(is_positive, ends))
+        mask[target] = orthant[source]
+
+    return mask
+
+
+
+if njit is not None:
+
+    @njit(parallel=True, cache=True)
+    def _ellipsoid_mask(out, x0, y0, z0, R, radius):
+        # Evaluates the rotated quadric of an ellipsoid voxel by voxel,
+        # writing the occupancy directly into `out`. `out` is indexed as
+        # (y, x, z), with (x0, y0, z0) the coordinates of its first voxel.
+        # `R` is the rotation matrix and `radius` is in pixels.
+        for i in prange(out.shape[0]):
+            y = y0 + i
+            for j in range(out.shape[1]):
+                x = x0 + j
+                for k in range(out.shape[2]):
+                    z = z0 + k
+                    xr = (R[0, 0] * x + R[0, 1] * y + R[0, 2] * z) / radius[0]
+                    yr = (R[1, 0] * x + R[1, 1] * y + R[1, 2] * z) / radius[1]
+                    zr = (R[2, 0] * x + R[2, 1] * y + R[2, 2] * z) / radius[2]
+                    out[i, j, k] = xr * xr + yr * yr + zr * zr < 1
@@ -1,6 +1,8 @@
 import sys
 sys.path.append("..") # Adds the module to path
 
+import threading
+import types
 import unittest
 
 import deeptrack.scatterers as scatterers
@@ -11,6 +13,80 @@ from deeptrack.image import Image
 
 
 
+class FixedScatterer(scatterers.Scatterer):
+    # Scatterer that returns a given array, to test the post processing
+    # in Scatterer._process_and_get independently of the mask calculations.
+
+    def __init__(self, array, **kwargs):
+        super().__init__(array=array, position=(0, 0), position_unit="pixel", **kwargs)
+
+    def get(self, image, array, **kwargs):
+        return array
+
+
+
+def counting_subclass(cls, **attributes):
+    # Returns a subclass of cls that counts the masks it creates. Each
+    # subclass has a mask cache of its own.
+    def _create_mask(self, **kwargs):
+        type(self).created += 1
+        return cls._create_mask(self, **kwargs)
+
+    return type("Counting" + cls.__name__, (cls,), dict(created=0, _create_mask=_create_mask, **attributes))
+
+
+
+def ellipse_by_full_grid(radius, rotation, voxel_size):
+    # Evaluates an ellipse mask on a full meshgrid, as the original
+    # implementation of Ellipse.get did.
+    rad = radius[:2] / voxel_size[:2]
+    ceil = int(np.max(np.ceil(rad)))
+    X, Y = np.meshgrid(np.arange(-ceil, ceil), np.arange(-ceil, ceil))
+    if rotation != 0:
+        Xt =  (X * np.cos(-rotation) + Y * np.sin(-rotation))
+        Yt = (-X * np.sin(-rotation) + Y * np.cos(-rotation))
+        X = Xt
+        Y = Yt
+    mask = (X * X) / (rad[0] * rad[0]) + (Y * Y) / (rad[1] * rad[1]) < 1
+    return np.expand_dims(mask, axis=-1)
+
+
+
+def sphere_by_full_grid(radius, voxel_size):
+    # Evaluates a sphere mask on a full meshgrid, as the original
+    # implementation of Sphere.get did.
+    rad = radius / voxel_size
+    rad_ceil = np.ceil(rad)
+    x = np.arange(-rad_ceil[0], rad_ceil[0])
+    y = np.arange(-rad_ceil[1], rad_ceil[1])
+    z = np.arange(-rad_ceil[2], rad_ceil[2])
+    X, Y, Z = np.meshgrid((x / rad[0])**2, (y / rad[1])**2, (z / rad[2])**2)
+    return X + Y + Z <= 1
+
+
+
+def downsample_by_mean(image, upsample, upsample_axes):
+    # Downsamples as the original implementation did, by a reshape to
+    # interleaved block axes followed by a mean over them. The block axes
+    # are located explicitly, since the original `axes * 2 + 1` only holds
+    # when the upsampled axes are the leading ones.
+    pad_width = [(0, 0)] * image.ndim
+    for axis in upsample_axes:
+        pad_width[axis] = (0, -image.shape[axis] % upsample)
+    image = np.pad(image, pad_width, mode="constant")
+
+    new_shape = []
+    block_axes = []
+    for axis in range(image.ndim):
+        if axis in upsample_axes:
+            new_shape += [image.shape[axis] // upsample, upsample]
+            block_axes.append(len(new_shape) - 1)
+        else:
+            new_shape += [image.shape[axis]]
+    return np.reshape(image, new_shape).mean(axis=tuple(block_axes))
+
+
+
 class TestScatterers(unittest.TestCase):
     
     def test_PointParticle(self):
@@ -96,7 +172,282 @@ class TestScatterers(unittest.TestCase):
         self.assertIsInstance(output_image, Image)        
         self.assertEqual(output_image.shape, (64, 64, 1))        
 
-    
+
+    def test_Ellipsoid_backends(self):
+        # The numba, numexpr and NumPy paths should give identical masks,
+        # including integer radii where lattice points lie on the surface.
+        backends = {"numpy": (None, None)}
+        if scatterers.njit is not None:
+            backends["numba"] = (scatterers.njit, None)
+        if scatterers.numexpr is not None:
+            backends["numexpr"] = (None, scatterers.numexpr)
+        if len(backends) == 1:
+            self.skipTest("Neither numba nor numexpr is installed")
+
+        ellipsoid = scatterers.Ellipsoid(position=(0, 0), radius=1)
+        voxel_size = np.ones(3)
+        parameters = [
+            ((3, 3, 3), (0, 0, 0)),
+            ((9, 9, 9), (0, 0, 0)),
+            ((4, 6, 5), (0, 0, 0)),
+            ((2, 5, 3), (np.pi / 2, 0, 0)),
+            ((7, 4, 3), (0.3, 1.1, -0.7)),
+            ((2.5, 3.7, 1.2), (1.3, 0.2, 2.9)),
+        ]
+
+        njit, numexpr = scatterers.njit, scatterers.numexpr
+        try:
+            for radius, rotation in parameters:
+                masks = {}
+                for name, (scatterers.njit, scatterers.numexpr) in backends.items():
+                    masks[name] = ellipsoid._create_mask(radius=np.array(radius, dtype=float),
+                                                         rotation=np.array(rotation, dtype=float),
+                                                         voxel_size=voxel_size)
+                for name, mask in masks.items():
+                    np.testing.assert_array_equal(mask, masks["numpy"], err_msg=name)
+        finally:
+            scatterers.njit, scatterers.numexpr = njit, numexpr
+
+
+    def test_Ellipsoid_gpu_fallback(self):
+        # The GPU is only used when enabled, and a GPU that runs out of
+        # memory falls back to the CPU.
+        self.assertFalse(scatterers.USE_GPU)
+
+        class OutOfMemoryError(Exception):
+            pass
+
+        class OtherError(Exception):
+            pass
+
+        def arange(*args, **kwargs):
+            raise OutOfMemoryError()
+
+        cuda = types.SimpleNamespace(
+            memory=types.SimpleNamespace(OutOfMemoryError=OutOfMemoryError),
+            runtime=types.SimpleNamespace(CUDARuntimeError=OtherError,
+                                          getDeviceCount=lambda: 1),
+            driver=types.SimpleNamespace(CUDADriverError=OtherError),
+        )
+        fake_cupy = types.SimpleNamespace(cuda=cuda, arange=arange, float32=np.float32)
+
+        ellipsoid = scatterers.Ellipsoid(position=(0, 0), radius=1)
+        properties = dict(radius=np.array([7, 4, 3], dtype=float),
+                          rotation=np.array([0.3, 1.1, -0.7]),
+                          voxel_size=np.ones(3))
+        expected = ellipsoid._create_mask(**properties)
+
+        state = scatterers.cupy, scatterers.USE_GPU, scatterers._GPU_MIN_VOXELS
+        scatterers._gpu_available.cache_clear()
+        try:
+            scatterers.cupy = fake_cupy
+            scatterers.USE_GPU = True
+            scatterers._GPU_MIN_VOXELS = 1
+            self.assertTrue(scatterers._gpu_available())
+            np.testing.assert_array_equal(ellipsoid._create_mask(**properties), expected)
+        finally:
+            scatterers.cupy, scatterers.USE_GPU, scatterers._GPU_MIN_VOXELS = state
+            scatterers._gpu_available.cache_clear()
+
+
+    def test_Scatterer_downsampling(self):
+        # Compares the block sums in Scatterer._process_and_get to a
+        # reshape followed by a mean. upsample_axes=None upsamples all axes.
+        # The uint8 and int8 images are not binary, and would overflow if
+        # summed in a type sized for binary masks or in their own type.
+        rng = np.random.RandomState(1)
+        parameters = [
+            ((0, 1), (7, 9, 3)),
+            ((0, 1), (8, 6, 1)),
+            ((2,), (4, 5, 7)),
+            ((2,), (3, 3, 9)),
+            (None, (7, 9, 5)),
+            (None, (6, 6, 6)),
+        ]
+
+        for upsample_axes, shape in parameters:
+            axes = range(3) if upsample_axes is None else upsample_axes
+            for upsample in (2, 3):
+                images = [
+                    rng.uniform(-1, 1, shape),
+                    rng.uniform(size=shape) < 0.5,
+                    rng.randint(200, 256, size=shape).astype(np.uint8),
+                    rng.randint(100, 128, size=shape).astype(np.int8),
+                    rng.randint(-128, -100, size=shape).astype(np.int8),
+                ]
+                for image in images:
+                    scatterer = FixedScatterer(image,
+                                               upsample=upsample,
+                                               upsample_axes=upsample_axes,
+                                               crop_empty=False)
+                    output = scatterer.resolve(voxel_size=np.ones(3))
+                    expected = downsample_by_mean(image, upsample, axes)
+
+                    self.assertEqual(output.shape, expected.shape)
+                    np.testing.assert_allclose(output, expected, rtol=1e-6, atol=1e-12)
+                    if image.dtype == bool:
+                        self.assertEqual(output.dtype, np.float32)
+                    else:
+                        self.assertEqual(output.dtype, np.float64)
+
+
+    def test_Scatterer_mask_cache(self):
+        Sphere = counting_subclass(scatterers.Sphere)
+        sphere = Sphere(position=(0, 0), position_unit="pixel", radius=5e-7)
+        voxel_size = np.full(3, 1e-7)
+
+        first = sphere.resolve(voxel_size=voxel_size)
+        second = sphere.resolve(voxel_size=voxel_size)
+        self.assertEqual(Sphere.created, 1)
+        np.testing.assert_array_equal(first, second)
+
+        # The resolved image is a writable copy of the cached mask
+        self.assertTrue(second.flags.writeable)
+        second[:] = 0
+        third = sphere.resolve(voxel_size=voxel_size)
+        np.testing.assert_array_equal(first, third)
+
+
+    def test_Scatterer_mask_cache_lru(self):
+        Sphere = counting_subclass(scatterers.Sphere, __mask_cache_size__=2)
+        sphere = Sphere(position=(0, 0), radius=1)
+        voxel_size = np.ones(3)
+
+        for radius in (3, 4, 3, 5, 3, 4):
+            sphere.get(None, radius=radius, voxel_size=voxel_size)
+
+        # 3 is kept as the most recently used, so 5 evicts 4
+        self.assertEqual(Sphere.created, 4)
+
+
+    def test_Scatterer_mask_cache_disabled(self):
+        Sphere = counting_subclass(scatterers.Sphere, __mask_cache_size__=0)
+        sphere = Sphere(position=(0, 0), radius=1)
+
+        for _ in range(2):
+            mask = sphere.get(None, radius=3, voxel_size=np.ones(3))
+        self.assertEqual(Sphere.created, 2)
+        self.assertNotIn(Sphere, scatterers._MASK_CACHE)
+        self.assertTrue(mask.flags.writeable)
+
+
+    def test_Scatterer_mask_cache_bytes(self):
+        # Masks larger than __mask_cache_bytes__ are not cached
+        Sphere = counting_subclass(scatterers.Sphere, __mask_cache_bytes__=100)
+        sphere = Sphere(position=(0, 0), radius=1)
+
+        for _ in range(2):
+            sphere.get(None, radius=1, voxel_size=np.ones(3))
+        for _ in range(2):
+            sphere.get(None, radius=3, voxel_size=np.ones(3))
+        self.assertEqual(Sphere.created, 3)
+        self.assertTrue(sum(mask.nbytes for mask in scatterers._MASK_CACHE[Sphere].values()) <= 100)
+
+
+    def test_Scatterer_mask_cache_threads(self):
+        # Gets masks from several threads, as keras does with generators.
+        # The masks are cheap to create, and thread switches are frequent,
+        # such that unguarded changes to the cache collide.
+        class Bar(scatterers.Scatterer):
+            __mask_cache_size__ = 16
+
+            def get(self, image, **kwargs):
+                return self._get_cached_mask(**kwargs)
+
+            def _create_mask(self, length):
+                return np.ones((length, 1, 1), dtype=bool)
+
+        bar = Bar(position=(0, 0))
+        errors = []
+
+        def get_masks(seed):
+            rng = np.random.RandomState(seed)
+            try:
+                for length in rng.randint(1, 64, size=5000):
+                    self.assertEqual(bar.get(None, length=length).shape, (length, 1, 1))
+            except Exception as error:
+                errors.append(error)
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=get_masks, args=(seed,)) for seed in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        self.assertEqual(errors, [])
+        cache = scatterers._MASK_CACHE[Bar]
+        self.assertTrue(len(cache) <= 16)
+        self.assertEqual(scatterers._MASK_CACHE_BYTES[Bar], sum(mask.nbytes for mask in cache.values()))
+
+
+    def test_Ellipse_rotated_mask(self):
+        # Integer radii put lattice points exactly on the boundary, where
+        # the order of the arithmetic decides whether they are inside.
+        ellipse = scatterers.Ellipse(position=(0, 0), radius=1, rotation=0)
+        for voxel_size in (np.ones(3), np.array([1, 1.3, 1])):
+            for radius in ((5, 10), (10, 5), (13, 13), (7, 24), (2.5, 0.6)):
+                for rotation in (np.pi / 2, np.pi, 0.3, -2.1):
+                    radius = np.array(radius, dtype=float)
+                    mask = ellipse._create_mask(radius=radius, rotation=rotation, voxel_size=voxel_size)
+                    np.testing.assert_array_equal(mask != 0, ellipse_by_full_grid(radius, rotation, voxel_size))
+
+
+    def test_Sphere_mask(self):
+        # The octant that is evaluated is reflected into the full mask,
+        # which should equal a full-grid evaluation.
+        sphere = scatterers.Sphere(position=(0, 0), radius=1)
+        voxel_sizes = [np.ones(3), np.array([1, 1.3, 0.8]), np.array([2, 1, 1])]
+        for voxel_size in voxel_sizes:
+            for radius in (0.4, 1, 2, 3, 4, 7, 2.5, 5.7):
+                mask = sphere._create_mask(radius=radius, voxel_size=voxel_size)
+                expected = sphere_by_full_grid(radius, voxel_size)
+                self.assertEqual(mask.shape, expected.shape)
+                np.testing.assert_array_equal(mask != 0, expected)
+
+
+    def test_Ellipse_mask(self):
+        # Unrotated ellipses are evaluated on one quadrant and reflected.
+        ellipse = scatterers.Ellipse(position=(0, 0), radius=1, rotation=0)
+        voxel_sizes = [np.ones(3), np.array([1, 1.3, 1]), np.array([2, 1, 1])]
+        radii = [(0.4, 0.4), (1, 1), (2, 2), (3, 5), (4, 7), (5, 10), (0.3, 2.5), (5.7, 3.2)]
+        for voxel_size in voxel_sizes:
+            for radius in radii:
+                radius = np.array(radius, dtype=float)
+                mask = ellipse._create_mask(radius=radius, rotation=0, voxel_size=voxel_size)
+                expected = ellipse_by_full_grid(radius, 0, voxel_size)
+                self.assertEqual(mask.shape, expected.shape)
+                np.testing.assert_array_equal(mask != 0, expected)
+
+
+    def test_Ellipsoid_properties(self):
+        ellipsoid = scatterers.Ellipsoid(position=(0, 0), radius=1)
+        parameters = [
+            # (radius, expected radius, rotation, expected rotation)
+            (1, (1, 1, 1), 0.5, (0.5, 0, 0)),
+            ((1,), (1, 1, 1), (0.5,), (0.5, 0, 0)),
+            ((1, 2), (1, 2, 2), (0.5, 0.2), (0.5, 0.2, 0)),
+            ((1, 2, 3), (1, 2, 3), (0.5, 0.2, 0.1), (0.5, 0.2, 0.1)),
+            (np.array([1, 2, 3, 4]), (1, 2, 3), np.array([0.5, 0.2, 0.1, 0.4]), (0.5, 0.2, 0.1)),
+        ]
+
+        for radius, expected_radius, rotation, expected_rotation in parameters:
+            properties = ellipsoid._process_properties({"radius": radius, "rotation": rotation})
+            self.assertIsInstance(properties["radius"], tuple)
+            self.assertIsInstance(properties["rotation"], tuple)
+            self.assertEqual(properties["radius"], expected_radius)
+            self.assertEqual(properties["rotation"], expected_rotation)
+
+        with self.assertRaises(ValueError):
+            ellipsoid._process_properties({"radius": (), "rotation": 0})
+        with self.assertRaises(ValueError):
+            ellipsoid._process_properties({"radius": 1, "rotation": []})
+
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file